@@ -1,11 +1,18 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-from datetime import datetime
+import time
+from dateutil.tz import tzlocal
 from PIL import Image, ImageDraw, ImageFont
-from streamlit_image_coordinates import streamlit_image_coordinates
+try:
+    from streamlit_image_coordinates import streamlit_image_coordinates
+except ImportError:
+    streamlit_image_coordinates = None
 
 LINE_KINDS = ['vertical', 'plane_1', 'plane_2']
+ANNOTATION_COLUMNS = ['x', 'y', 'label', 'timestamp']
+# Longest side of the image sent to the click-capture component
+MAX_COMPONENT_SIDE = 1200
 
 def main():
     st.set_page_config(page_title="Image Annotator", layout="wide")
@@ -13,8 +20,14 @@ def main():
     st.title("Image Annotation Tool")
     
     # Initialize session state variables if they don't exist
-    if 'annotations' not in st.session_state:
-        st.session_state.annotations = pd.DataFrame(columns=['x', 'y', 'label', 'timestamp'])
+    # Annotations are kept as a list of dicts; a DataFrame is only built for display/export
+    if 'annotations_list' not in st.session_state:
+        st.session_state.annotations_list = []
+    
+    # Preallocated (capacity, 2) buffer mirroring the annotation coordinates for drawing
+    if 'coord_buf' not in st.session_state:
+        st.session_state.coord_buf = np.empty((16, 2), dtype=np.float32)
+        st.session_state.n_coords = 0
     
     if 'image_width' not in st.session_state:
         st.session_state.image_width = 0
@@ -31,21 +44,35 @@ def main():
     if 'current_point' not in st.session_state:
         st.session_state.current_point = None
         
+    # Cheap emptiness flag reused throughout this rerun
+    has_annos = bool(st.session_state.annotations_list)
+    
     # Sidebar for uploading image and other controls
     with st.sidebar:
         st.header("Upload Image")
         uploaded_file = st.file_uploader("Choose an image file", type=["jpg", "jpeg", "png"])
+        image = _load_upload(uploaded_file)
         
-        st.header("Annotation Controls")
-        point_size = st.slider("Point Size", 5, 30, 15)
-        
-        # Image sizing options
+        # Image sizing options; the click-capture image is capped at MAX_COMPONENT_SIDE
+        # on its long side, so the slider only offers widths within that cap
         st.header("Image Display")
-        st.session_state.display_width = st.slider("Display Width", 400, 1600, 800)
+        max_width = MAX_COMPONENT_SIDE
+        if image is not None:
+            # Very tall images would round down to a width of 0 or 1; keep a usable range
+            max_width = max(2, int(MAX_COMPONENT_SIDE * image.width / max(image.size)))
+        min_width = max(1, min(400, max_width // 2))
+        st.session_state.display_width = st.slider(
+            "Display Width", min_width, max_width, min(800, max_width)
+        )
         
         # Download button (appears when annotations exist)
-        if len(st.session_state.annotations) > 0:
-            csv = convert_df_to_csv(st.session_state.annotations)
+        if has_annos:
+            # Keep only the last CSV in session state; re-encode it only after the records change
+            csv_key = tuple(tuple(a.values()) for a in st.session_state.annotations_list)
+            if st.session_state.get('csv_key') != csv_key:
+                st.session_state.csv_data = convert_df_to_csv(st.session_state.annotations_list)
+                st.session_state.csv_key = csv_key
+            csv = st.session_state.csv_data
             st.download_button(
                 label="Download Annotations (CSV)",
                 data=csv,
@@ -53,17 +80,11 @@ def main():
                 mime="text/csv",
             )
             
-            # Also add clear button
-            if st.button("Clear All Annotations"):
-                st.session_state.annotations = pd.DataFrame(columns=['x', 'y', 'label', 'timestamp'])
-                st.session_state.awaiting_label = False
-                st.session_state.current_point = None
-                st.rerun()
+            # Also add clear button; the callback runs before the click's own rerun
+            st.button("Clear All Annotations", on_click=_clear_annotations)
 
     # Main area for image display and annotation
-    if uploaded_file is not None:
-        # Convert uploaded file to PIL Image
-        image = Image.open(uploaded_file)
+    if image is not None:
         width, height = image.size
         st.session_state.image_width = width
         st.session_state.image_height = height
@@ -72,97 +93,12 @@ def main():
         col1, col2 = st.columns([3, 1])
         
         with col1:
-            # Display image with canvas overlay for annotation
-            st.subheader("Click on the image to annotate")
-            
-            # Resize image for display while maintaining aspect ratio
-            aspect_ratio = height / width
-            display_width = st.session_state.display_width
-            display_height = int(display_width * aspect_ratio)
-            
-            # Create a display image with existing annotations
-            display_image = image.resize((display_width, display_height), Image.LANCZOS)
-            
-            # Calculate scale factors for annotation coordinates
-            scale_x = width / display_width
-            scale_y = height / display_height
-            
-            # Convert to RGB if it's not already (for drawing colored points)
-            if display_image.mode != 'RGB':
-                display_image = display_image.convert('RGB')
-                
-            # Draw existing annotations on the image
-            if len(st.session_state.annotations) > 0:
-                draw = ImageDraw.Draw(display_image)
-                
-                # Draw all annotations
-                for _, row in st.session_state.annotations.iterrows():
-                    # Convert original coordinates to display coordinates
-                    display_x = row['x'] / scale_x
-                    display_y = row['y'] / scale_y
-                    
-                    # Draw a circle at the point
-                    draw.ellipse(
-                        (display_x-point_size, display_y-point_size, display_x+point_size, display_y+point_size), 
-                        fill='red', 
-                        outline='white'
-                    )
-                    
-                    # Draw the label text with a background for visibility
-                    text_x = display_x + point_size + 5
-                    text_y = display_y - point_size
-                    
-                    # Measure text width for background
-                    font = ImageFont.load_default()
-                    text_width, text_height = draw.textsize(row['label'], font=font) if hasattr(draw, 'textsize') else (len(row['label']) * 7, 12)
-                    
-                    # Draw text background
-                    draw.rectangle(
-                        [text_x - 2, text_y - 2, text_x + text_width + 2, text_y + text_height + 2],
-                        fill=(0, 0, 0),
-                        outline=None
-                    )
-                    
-                    # Draw the text
-                    draw.text((text_x, text_y), row['label'], fill='white')
-            
-            try:
-                # Get click coordinates using streamlit_image_coordinates
-                clicked_coords = streamlit_image_coordinates(
-                    display_image,
-                    key="annotator"
-                )
-                
-                # If image was clicked, store coordinates for annotation
-                if clicked_coords and not st.session_state.awaiting_label:
-                    # Convert display coordinates back to original image coordinates
-                    original_x = clicked_coords["x"] * scale_x
-                    original_y = clicked_coords["y"] * scale_y
-                    st.session_state.current_point = (original_x, original_y)
-                    st.session_state.awaiting_label = True
-                    
-                    # Show a message confirming the click
-                    st.success(f"Point selected at original coordinates: ({original_x:.1f}, {original_y:.1f})")
-                    st.rerun()  # This forces a refresh to show the label input form
-            except ImportError:
-                # Fallback method using a placeholder
-                st.warning("For better annotation experience, install: pip install streamlit-image-coordinates")
-                
-                # Display the image
-                st.image(display_image, use_container_width=False)
-                
-                # Manual coordinate input
-                st.subheader("Enter coordinates manually:")
-                col_x, col_y = st.columns(2)
-                with col_x:
-                    x = st.number_input("X coordinate:", min_value=0, max_value=width, value=width//2)
-                with col_y:
-                    y = st.number_input("Y coordinate:", min_value=0, max_value=height, value=height//2)
-                
-                if st.button("Set Point"):
-                    st.session_state.current_point = (x, y)
-                    st.session_state.awaiting_label = True
-                    st.rerun()
+            _annotate_panel(
+                image,
+                uploaded_file.file_id,
+                st.session_state.annotations_list,
+                st.session_state.display_width,
+            )
         
         with col2:
             st.header("Add Annotation")
@@ -176,57 +112,236 @@ def main():
                 with st.form("annotation_form"):
                     label = st.text_input("Label")
                     submitted = st.form_submit_button("Add Annotation")
-                    cancel = st.form_submit_button("Cancel")
+                    st.form_submit_button("Cancel", on_click=_reset_pending_point)
                     
                     if submitted and label:
                         # Add new annotation
-                        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        new_row = pd.DataFrame({
-                            'x': [x],
-                            'y': [y],
-                            'label': [label],
-                            'timestamp': [timestamp]
+                        # Store raw nanoseconds; formatting is deferred to CSV export
+                        timestamp = time.time_ns()
+                        st.session_state.annotations_list.append({
+                            'x': x,
+                            'y': y,
+                            'label': label,
+                            'timestamp': timestamp
                         })
-                        
-                        # Update annotations
-                        if len(st.session_state.annotations) == 0:
-                            st.session_state.annotations = new_row
-                        else:
-                            st.session_state.annotations = pd.concat(
-                                [st.session_state.annotations, new_row], 
-                                ignore_index=True
-                            )
+                        _append_coord(x, y)
                         
                         # Reset current point
                         st.session_state.current_point = None
                         st.session_state.awaiting_label = False
                         st.rerun()
-                        
-                    if cancel:
-                        st.session_state.current_point = None
-                        st.session_state.awaiting_label = False
-                        st.rerun()
             else:
                 st.write("👈 Click on the image to select a point")
             
             # Display table of annotations
-            if not st.session_state.annotations.empty:
+            if has_annos:
+                # Materialize the annotations only for the table
+                annotations = pd.DataFrame.from_records(st.session_state.annotations_list, columns=ANNOTATION_COLUMNS)
+                
                 st.header("Current Annotations")
                 st.dataframe(
-                    st.session_state.annotations[['x', 'y', 'label']], 
+                    annotations[['x', 'y', 'label']], 
                     use_container_width=True
                 )
                 
                 # Add undo button
                 if st.button("Undo Last Annotation"):
-                    if len(st.session_state.annotations) > 0:
-                        st.session_state.annotations = st.session_state.annotations.iloc[:-1]
+                    if st.session_state.annotations_list:
+                        _pop_annotation()
                         st.rerun()
     else:
         st.info("Please upload an image to start annotating")
 
-def convert_df_to_csv(df):
-    """Convert dataframe to CSV string for download"""
+def _load_upload(uploaded_file):
+    """Return the uploaded image converted to RGB, decoding it once per file"""
+    if uploaded_file is None:
+        # Release the decoded and resized images once the file is removed
+        for key in ('source_img', 'source_id', 'base_img', 'base_rgba', 'base_key',
+                    'overlay_img', 'overlay_key'):
+            st.session_state.pop(key, None)
+        return None
+    
+    if st.session_state.get('source_id') != uploaded_file.file_id:
+        image = Image.open(uploaded_file)
+        image.load()
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        st.session_state.source_img = image
+        st.session_state.source_id = uploaded_file.file_id
+    return st.session_state.source_img
+
+def _reset_pending_point():
+    """Discard the selected point that is waiting for a label"""
+    st.session_state.current_point = None
+    st.session_state.awaiting_label = False
+
+def _clear_annotations():
+    """Remove all annotations and any pending point"""
+    st.session_state.annotations_list.clear()
+    st.session_state.n_coords = 0
+    _reset_pending_point()
+
+def _pop_annotation():
+    """Remove the last annotation record and its buffered coordinates"""
+    st.session_state.annotations_list.pop()
+    st.session_state.n_coords -= 1
+
+def _append_coord(x, y):
+    """Append a point to the coordinate buffer, growing it by 1.5x when full"""
+    buf = st.session_state.coord_buf
+    n = st.session_state.n_coords
+    if n == len(buf):
+        new_buf = np.empty((int(len(buf) * 1.5) + 1, 2), dtype=np.float32)
+        new_buf[:n] = buf
+        buf = st.session_state.coord_buf = new_buf
+    buf[n] = (x, y)
+    st.session_state.n_coords = n + 1
+
+@st.fragment
+def _annotate_panel(image, file_id, annotations, display_width):
+    """Render the point size control and the clickable annotated image.
+    
+    Changing the point size only reruns this panel. The arguments only change
+    on full-app reruns, so reusing them on panel-only reruns is safe.
+    """
+    # Display image with canvas overlay for annotation
+    st.subheader("Click on the image to annotate")
+    point_size = st.slider("Point Size", 5, 30, 15)
+    
+    # Keep the resized base image in session state; it only changes with the file or width
+    width, height = image.size
+    base_key = (file_id, display_width)
+    if st.session_state.get('base_key') != base_key:
+        st.session_state.base_img = _resize_for_display(image, display_width)
+        # RGBA copy for compositing, converted once per base rather than per overlay render
+        st.session_state.base_rgba = st.session_state.base_img.convert('RGBA')
+        st.session_state.base_key = base_key
+    
+    # Scale factors from component coordinates back to the original image
+    to_original = np.array(
+        [width / st.session_state.base_img.width, height / st.session_state.base_img.height]
+    )
+    
+    # Composite existing annotations onto the base image, keeping only the last
+    # composite in session state; without annotations the base image is shown as is
+    if annotations:
+        coords = st.session_state.coord_buf[:st.session_state.n_coords]
+        labels = tuple(a['label'] for a in annotations)
+        overlay_key = (base_key, coords.tobytes(), labels, point_size)
+        if st.session_state.get('overlay_key') != overlay_key:
+            st.session_state.overlay_img = _render_overlay(
+                st.session_state.base_rgba, (width, height), coords, labels, point_size
+            )
+            st.session_state.overlay_key = overlay_key
+        display_image = st.session_state.overlay_img
+    else:
+        display_image = st.session_state.base_img
+    
+    if streamlit_image_coordinates is not None:
+        # Get click coordinates using streamlit_image_coordinates
+        clicked_coords = streamlit_image_coordinates(
+            display_image,
+            key="annotator"
+        )
+        
+        # If image was clicked, store coordinates for annotation
+        if clicked_coords and not st.session_state.awaiting_label:
+            # Convert display coordinates back to original image coordinates
+            original_x, original_y = (
+                np.array([clicked_coords["x"], clicked_coords["y"]]) * to_original
+            ).tolist()
+            st.session_state.current_point = (original_x, original_y)
+            st.session_state.awaiting_label = True
+            
+            # Show a message confirming the click
+            st.success(f"Point selected at original coordinates: ({original_x:.1f}, {original_y:.1f})")
+            st.rerun()  # This forces a refresh to show the label input form
+    else:
+        # Fallback method using a placeholder
+        st.warning("For better annotation experience, install: pip install streamlit-image-coordinates")
+        
+        # Display the image
+        st.image(display_image, use_container_width=False)
+        
+        # Manual coordinate input
+        st.subheader("Enter coordinates manually:")
+        col_x, col_y = st.columns(2)
+        with col_x:
+            x = st.number_input("X coordinate:", min_value=0, max_value=width, value=width//2)
+        with col_y:
+            y = st.number_input("Y coordinate:", min_value=0, max_value=height, value=height//2)
+        
+        if st.button("Set Point"):
+            st.session_state.current_point = (x, y)
+            st.session_state.awaiting_label = True
+            st.rerun()
+
+def _resize_for_display(image, display_width):
+    """Resize an RGB image to the display width, keeping its aspect ratio"""
+    width, height = image.size
+    display_height = int(display_width * height / width)
+    return image.resize((display_width, display_height), Image.BILINEAR)
+
+def _render_overlay(base_image, image_size, coords, labels, point_size):
+    """Composite labelled annotation points onto the resized RGBA base image.
+    
+    coords is an (N, 2) array of original image coordinates matching labels.
+    """
+    # Draw on a transparent layer; the base image itself is left untouched
+    overlay = Image.new('RGBA', base_image.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    
+    # Convert all original coordinates to display coordinates with one scale multiply
+    width, height = image_size
+    to_display = np.array(
+        [base_image.width / width, base_image.height / height], dtype=np.float32
+    )
+    display_xy = coords * to_display
+    
+    # Precompute all circle bounding boxes as (x0, y0, x1, y1) rows
+    boxes = np.hstack([display_xy - point_size, display_xy + point_size]).tolist()
+    
+    # Load the font once and use a single line height for label backgrounds
+    font = ImageFont.load_default()
+    text_height = font.getbbox('Ag')[3]
+    
+    # Measure each distinct label once; most annotations reuse a few labels (see LINE_KINDS)
+    label_widths = {label: font.getlength(label) for label in set(labels)}
+    
+    # Draw all circles with the same style in one pass
+    for box in boxes:
+        draw.ellipse(box, fill='red', outline='white')
+    
+    # Draw the label text with a background for visibility
+    for (display_x, display_y), label in zip(display_xy.tolist(), labels):
+        text_x = display_x + point_size + 5
+        text_y = display_y - point_size
+        text_width = label_widths[label]
+        
+        # Draw text background
+        draw.rectangle(
+            [text_x - 2, text_y - 2, text_x + text_width + 2, text_y + text_height + 2],
+            fill=(0, 0, 0),
+            outline=None
+        )
+        
+        # Draw the text
+        draw.text((text_x, text_y), label, fill='white', font=font)
+    # The composite is fully opaque; return it as RGB so the PNG the component
+    # encodes on every rerun carries no alpha channel
+    return Image.alpha_composite(base_image, overlay).convert('RGB')
+
+def convert_df_to_csv(records):
+    """Convert a list of annotation records to CSV string for download"""
+    df = pd.DataFrame.from_records(records, columns=ANNOTATION_COLUMNS)
+    
+    # Format all nanosecond timestamps in one vectorized pass; tzlocal() is the system
+    # zone itself (not a fixed offset), so DST changes are handled per timestamp
+    df['timestamp'] = (
+        pd.to_datetime(df['timestamp'], unit='ns', utc=True)
+        .dt.tz_convert(tzlocal())
+        .dt.strftime('%Y-%m-%d %H:%M:%S')
+    )
     return df.to_csv(index=False).encode('utf-8')
 
 if __name__ == "__main__":